@@ -16,14 +16,27 @@ from tkinter import ttk, messagebox
 import qrcode
 from PIL import Image, ImageTk, ImageDraw, ImageFont
 import threading
+import queue
 import time
 import cups
 import os
+import shutil
+import subprocess
+import hashlib
 import tempfile
+import io
 from pdf2image import convert_from_path
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 import json
+import re
+import bisect
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Configuration
@@ -32,6 +45,1290 @@ PRINTER_NAME = "HP_LaserJet_M208dw"  # Your printer name in CUPS
 QR_URL = "https://printervendingmachine.onrender.com/"  # Your web app URL
 KONAMI_CODE = ['Up', 'Up', 'Down', 'Down', 'Left', 'Right', 'Left', 'Right', 'b', 'a']
 
+# Upload handling
+SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".revive_kiosk", "spool")  # On disk, not the tmpfs /tmp
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024  # Largest accepted upload in bytes
+UPLOAD_CHUNK_SIZE = 64 * 1024  # Write buffer per upload in bytes
+QUEUE_JOURNAL = os.path.join(SPOOL_DIR, "queue.jsonl")  # Durable upload queue
+UPLOADS_DIR = os.path.join(SPOOL_DIR, "uploads")  # Partial resumable uploads
+UPLOAD_EXPIRY = 24 * 60 * 60  # Seconds before an abandoned resumable upload is deleted
+STORE_DIR = os.path.join(os.path.expanduser("~"), ".revive_kiosk", "store")  # Content-addressed documents
+STORE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # Evict least recently used documents above this
+THUMB_DIR = os.path.join(os.path.expanduser("~"), ".revive_kiosk", "thumbnails")  # Rendered pages
+THUMB_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Evict least recently used renders above this
+INGEST_WORKERS = 2  # Uploads pre-processed in parallel as they arrive
+INGEST_WARM_PAGES = 24  # Preview pages rendered ahead at ingest
+RASTER_PROCESSES = os.cpu_count() or 1  # Poppler processes rendering page ranges in parallel
+RASTER_CHUNK_PAGES = 4  # Pages per poppler process when rendering ranges
+
+# Preview
+PREVIEW_SIZE = (480, 580)  # Largest page image shown on the preview canvas
+PREVIEW_COLOR_MODE = "auto"  # "auto" (from the printer's capabilities), "color", "gray" or "mono"
+PREVIEW_MODES = {'color': 'RGB', 'gray': 'L', 'mono': '1'}  # Setting -> PIL image mode
+PAGE_RANGE_HINT = "e.g. 1-3,5"  # Placeholder text in the custom range entry
+RENDER_WORKERS = 2  # Background threads rasterizing previews
+DRAFT_SCALE = 4  # On-screen pages are first shown from a render this many times smaller
+PREFETCH_WORKERS = 1  # Background threads rendering neighbouring pages
+PREFETCH_AHEAD = 2  # Pages after the current one to render in advance
+PREFETCH_BEHIND = 1  # Pages before the current one to render in advance
+GRID_COLUMNS = 3  # Thumbnails per row in grid view
+GRID_CELL = (160, 200)  # Grid cell size on the preview canvas (thumbnail plus page number)
+GRID_THUMB_SIZE = (140, 170)  # Largest thumbnail in a grid cell
+ZOOM_LEVELS = (1, 2, 3, 4)  # Preview magnifications, relative to the page fitted to the canvas
+TILE_SIZE = 256  # Edge of a zoomed preview tile in pixels
+TILE_CACHE_BYTES = 16 * 1024 * 1024  # Rendered zoom tiles kept for panning back and forth
+PAGE_CACHE_FRACTION = 0.10  # Share of available RAM the preview page cache may use
+PAGE_CACHE_MIN_BYTES = 16 * 1024 * 1024
+PAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+PHOTO_CACHE_BYTES = 32 * 1024 * 1024  # Display-ready Tk images kept for quick page flips
+UI_POLL_INTERVAL = 50  # Milliseconds between checks for results from worker threads
+
+# Large documents
+LARGE_DOC_PAGES = 100  # Documents with more pages are handled in large-document mode
+LARGE_DOC_BYTES = 50 * 1024 * 1024  # Documents bigger than this are handled in large-document mode
+LARGE_DOC_CACHE_BYTES = 24 * 1024 * 1024  # Fixed preview cache ceiling in large-document mode
+LARGE_DOC_WARM_PAGES = 2  # Preview pages rendered ahead at ingest in large-document mode
+MAX_PRINT_PAGES = 150  # Most pages a single job may print
+
+# Print job tracking
+JOB_EVENT_INTERVAL = 0.2  # Seconds between pulls of new job notifications from CUPS
+JOB_SUBSCRIPTION_LEASE = 3600  # Seconds a notification subscription lasts unless renewed
+JOB_STATES_KEPT = 256  # Finished job states remembered for late waiters
+JOB_RETRY_DELAY = 2  # Seconds before resubscribing after losing cupsd (doubles up to a minute)
+PRINT_JOB_TIMEOUT = 15 * 60  # Seconds to wait for a print job to finish
+PRINT_WORKERS = 2  # CUPS jobs in flight at once
+PRINT_QUEUE_SIZE = 16  # Print jobs waiting for a free spooler worker
+CUPS_POOL_SIZE = PRINT_WORKERS + 2  # CUPS connections: spooler workers, job tracker and the UI
+CUPS_WAIT_TIMEOUT = 10  # Seconds to wait for a free, working CUPS connection
+CUPS_CHECK_AFTER = 30  # Seconds a connection may sit idle before it is checked on checkout
+JOB_STATUS_CHECK_INTERVAL = 30  # Seconds between direct state checks of waited-on jobs
+JOB_BATCH_SPAN = 32  # Widest range of job IDs looked up with a single request
+
+# File receiver server
+SERVER_MODE = "pooled"  # "pooled" (worker pool) or "development" (Werkzeug dev server)
+SERVER_PORT = 5001
+SERVER_WORKERS = 8  # Worker threads handling connections in pooled mode
+SERVER_BACKLOG = 64  # Pending connections the kernel queues for us
+SERVER_REQUEST_TIMEOUT = 60  # Seconds without data before a request is dropped
+
+
+def fit_size(box, page_size=None):
+    """Return the pdf2image size argument that fits a page inside box"""
+    if page_size:
+        width, height = page_size
+        return (box[0], None) if width * box[1] > height * box[0] else (None, box[1])
+    return min(box)
+
+
+def render_range(path, first, last, box, page_size=None, mode='RGB'):
+    """Rasterize pages first..last (0-based, inclusive) in one poppler process.
+
+    mode is the PIL image mode to produce: 'RGB', 'L' (poppler renders
+    grayscale directly) or '1' (grayscale dithered to black and white, like
+    a mono laser prints it).
+    """
+    images = convert_from_path(
+        path,
+        size=fit_size(box, page_size),
+        first_page=first + 1,
+        last_page=last + 1,
+        grayscale=mode != 'RGB'
+    )
+    for index, img in enumerate(images):
+        img.thumbnail(box)
+        if mode == '1':
+            images[index] = img.convert('1')
+    return images
+
+
+def render_tile(path, page, size, tile, mode='RGB', timeout=30):
+    """Rasterize one rectangle of a page (0-based) scaled to size=(width, height).
+
+    tile is (x, y, width, height) in pixels of the scaled page. Poppler only
+    renders the pixels inside the tile, so a zoomed-in view costs time in
+    proportion to what is on screen rather than to the zoomed page size.
+    """
+    x, y, width, height = tile
+    args = [
+        'pdftoppm', '-f', str(page + 1), '-l', str(page + 1), '-singlefile',
+        '-scale-to-x', str(size[0]), '-scale-to-y', str(size[1]),
+        '-x', str(x), '-y', str(y), '-W', str(width), '-H', str(height)
+    ]
+    if mode != 'RGB':
+        args.append('-gray')
+    # Without an output root pdftoppm writes the image to stdout
+    result = subprocess.run(args + [path], capture_output=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode(errors='replace').strip() or "pdftoppm failed")
+    img = Image.open(io.BytesIO(result.stdout))
+    img.load()
+    return img.convert('1') if mode == '1' else img
+
+
+def render_page(path, page, box, page_size=None, mode='RGB'):
+    """Rasterize one page (0-based) of a PDF to fit inside box=(width, height).
+
+    Poppler scales straight to the target size, so only the pixels that are
+    going to be displayed get rendered. page_size is the page's (width,
+    height) in points; without it the long side is fitted to the box.
+    """
+    return render_range(path, page, page, box, page_size, mode)[0]
+
+
+def rasterize_pages(path, pages, box, page_sizes=None, mode='RGB', processes=RASTER_PROCESSES):
+    """Yield (page, image) for the given 0-based pages, in page order.
+
+    The pages are split into short contiguous ranges and each range is
+    rendered by its own pdftoppm process, so long documents keep every core
+    busy. A range is yielded as soon as it and all ranges before it are
+    done. At most one range per process is rendered ahead of the consumer,
+    so memory use does not grow with the number of pages. Closing the
+    generator early stops rendering. page_sizes is the per-page list from
+    inspect_document(), if known.
+    """
+    ranges = []
+    for page in sorted(set(pages)):
+        if ranges and page == ranges[-1][1] + 1 and page - ranges[-1][0] < RASTER_CHUNK_PAGES:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    
+    pool = ThreadPoolExecutor(max_workers=processes, thread_name_prefix="raster")
+    pending = deque()
+    remaining = iter(ranges)
+    
+    def submit_next():
+        for first, last in remaining:
+            size = page_sizes[first] if page_sizes else None
+            pending.append((first, pool.submit(render_range, path, first, last, box, size, mode)))
+            return
+    
+    try:
+        for _ in range(processes):
+            submit_next()
+        while pending:
+            first, future = pending.popleft()
+            images = future.result()
+            submit_next()
+            for offset, img in enumerate(images):
+                yield first + offset, img
+            del images
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def inspect_document(path, timeout=10):
+    """Read page count, media boxes and rotation from the PDF structure.
+
+    A single pdfinfo run lists every page without rendering anything, which
+    takes milliseconds even for long documents. Returns a dict with
+    page_count, media_boxes ([x0, y0, x1, y1] in points), rotations and
+    page_sizes (displayed [width, height] with rotation applied).
+    """
+    # pdfinfo clamps the last page to the page count
+    result = subprocess.run(
+        ['pdfinfo', '-f', '1', '-l', str(2 ** 31 - 1), '-box', path],
+        capture_output=True, text=True, errors='replace', timeout=timeout
+    )
+    if result.returncode != 0:
+        raise ValueError(result.stderr.strip() or "Unreadable PDF")
+    
+    page_count = 0
+    sizes = {}
+    rotations = {}
+    media_boxes = {}
+    for line in result.stdout.splitlines():
+        if line.startswith('Pages:'):
+            page_count = int(line.split()[1])
+            continue
+        match = re.match(r'Page\s+(\d+)\s+(size|rot|MediaBox):\s+(.*)', line)
+        if not match:
+            continue
+        page, field, value = int(match.group(1)) - 1, match.group(2), match.group(3)
+        if field == 'size':
+            width, height = re.match(r'([\d.]+) x ([\d.]+)', value).groups()
+            sizes[page] = [float(width), float(height)]
+        elif field == 'rot':
+            rotations[page] = int(value) % 360
+        else:
+            media_boxes[page] = [float(v) for v in value.split()]
+    
+    page_sizes = []
+    for page in range(page_count):
+        width, height = sizes.get(page, sizes.get(0, [612.0, 792.0]))
+        if rotations.get(page, 0) in (90, 270):
+            width, height = height, width
+        page_sizes.append([width, height])
+    
+    return {
+        'page_count': page_count,
+        'media_boxes': [media_boxes.get(page) for page in range(page_count)],
+        'rotations': [rotations.get(page, 0) for page in range(page_count)],
+        'page_sizes': page_sizes
+    }
+
+
+def parse_page_range(text, page_count):
+    """Parse a page range like "1-3,5" into sorted, unique 1-based page numbers.
+
+    Accepts single pages, ranges (also open-ended, "7-" or "-3"), separated
+    by commas or spaces. Raises ValueError with a message that can be shown
+    to the user when the text is malformed or outside 1..page_count.
+    """
+    text = re.sub(r'\s*-\s*', '-', text.strip())
+    parts = [part for part in re.split(r'[,\s]+', text) if part]
+    if not parts:
+        raise ValueError("Enter pages like 1-3,5")
+    
+    pages = set()
+    for part in parts:
+        match = re.fullmatch(r'(\d+)|(\d*)-(\d*)', part)
+        if not match or part == '-':
+            raise ValueError(f"'{part}' is not a page or range")
+        if match.group(1):
+            start = end = int(match.group(1))
+        else:
+            start = int(match.group(2)) if match.group(2) else 1
+            end = int(match.group(3)) if match.group(3) else page_count
+        if start < 1 or end > page_count:
+            raise ValueError(f"Pages must be between 1 and {page_count}")
+        if start > end:
+            raise ValueError(f"'{part}' runs backwards")
+        pages.update(range(start, end + 1))
+    return sorted(pages)
+
+
+def format_page_range(pages):
+    """Return sorted 1-based page numbers as a normalized range string ("1-3,5")"""
+    ranges = []
+    for page in pages:
+        if ranges and page == ranges[-1][1] + 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ','.join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def is_large_document(path, page_count):
+    """Whether a document is big enough to be handled in large-document mode"""
+    return page_count > LARGE_DOC_PAGES or os.path.getsize(path) > LARGE_DOC_BYTES
+
+
+def available_memory():
+    """Return MemAvailable from /proc/meminfo in bytes, or None"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def image_nbytes(img):
+    """Approximate memory held by a PIL image"""
+    return img.width * img.height * len(img.getbands())
+
+
+def photo_nbytes(photo):
+    """Approximate memory held by a Tk photo image (32 bits per pixel)"""
+    return photo.width() * photo.height() * 4
+
+
+class PageCache:
+    """LRU cache of rendered pages held within a byte budget.
+
+    Least recently viewed pages are evicted first, and hit/miss counters
+    show how well the budget fits the way the kiosk is used. sizeof gives
+    the memory held by one entry.
+    """
+
+    def __init__(self, budget, sizeof=image_nbytes):
+        self.budget = budget
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (image, bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_meminfo(cls):
+        """Create a cache sized from the RAM available right now"""
+        available = available_memory()
+        if available is None:
+            return cls(PAGE_CACHE_MIN_BYTES)
+        budget = int(available * PAGE_CACHE_FRACTION)
+        return cls(max(PAGE_CACHE_MIN_BYTES, min(budget, PAGE_CACHE_MAX_BYTES)))
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """Return the cached image for key (marking it recently used), or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, img):
+        """Cache an image, evicting least recently used ones to stay in budget"""
+        nbytes = self.sizeof(img)
+        if nbytes > self.budget:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (img, nbytes)
+            self.size += nbytes
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def resize(self, budget):
+        """Change the byte budget, evicting least recently used images to fit"""
+        with self.lock:
+            self.budget = budget
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def stats(self):
+        """Return hit/miss counters and memory use"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'budget': self.budget
+            }
+
+
+class SpoolFile:
+    """Upload stream that writes chunks straight into the spool directory.
+
+    Werkzeug's multipart parser writes each chunk here as it reads it, so an
+    upload is never held in memory and never copied a second time. Going
+    over max_size deletes the partial file and aborts the request.
+    """
+
+    def __init__(self, directory, max_size):
+        fd, self.name = tempfile.mkstemp(prefix="upload_", suffix=".part", dir=directory)
+        self._file = os.fdopen(fd, 'w+b', buffering=UPLOAD_CHUNK_SIZE)
+        self.max_size = max_size
+        self.size = 0
+        self.persisted = False
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.discard()
+            raise RequestEntityTooLarge(f"Upload exceeds {self.max_size // (1024 * 1024)} MB limit")
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        """SHA-256 of everything written so far"""
+        return self.sha256.hexdigest()
+
+    def persist(self, path):
+        """Close the spool file and move it to its final path"""
+        # On disk before the rename, so a power cut cannot leave a short copy
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.name, path)
+        self.name = path
+        self.persisted = True
+
+    def discard(self):
+        """Close and delete the partial spool file"""
+        self._file.close()
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Flask request that spools uploaded files with SpoolFile"""
+
+    max_form_memory_size = UPLOAD_CHUNK_SIZE  # Non-file form fields stay small
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = SpoolFile(SPOOL_DIR, MAX_UPLOAD_SIZE)
+        self.spool_files.append(spool)
+        return spool
+
+    def discard_spool_files(self):
+        """Remove spool files that were not persisted by the handler"""
+        for spool in self.spool_files:
+            if not spool.persisted:
+                spool.discard()
+
+
+class ResumableUpload:
+    """One resumable upload, kept as <id>.part plus <id>.json in UPLOADS_DIR.
+
+    The size of the .part file is the authoritative offset, so progress
+    survives dropped connections and kiosk restarts alike.
+    """
+
+    def __init__(self, directory, upload_id, info):
+        self.upload_id = upload_id
+        self.info = info
+        self.part_path = os.path.join(directory, f"{upload_id}.part")
+        self.info_path = os.path.join(directory, f"{upload_id}.json")
+        self.lock = threading.Lock()  # One PATCH at a time
+        self.persisted = False
+
+    @property
+    def offset(self):
+        try:
+            return os.path.getsize(self.part_path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.offset == self.info['size']
+
+    def append(self, stream, length):
+        """Append up to length bytes from stream, returns the new offset.
+
+        Whatever arrived before a disconnect stays on disk, so the client
+        only resends from the returned (or HEAD-reported) offset.
+        """
+        remaining = min(length, self.info['size'] - self.offset)
+        with open(self.part_path, 'ab') as f:
+            while remaining > 0:
+                chunk = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        os.utime(self.info_path)  # Keep an active upload from expiring
+        return self.offset
+
+    def hexdigest(self):
+        """SHA-256 of the received bytes"""
+        sha256 = hashlib.sha256()
+        with open(self.part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def persist(self, path):
+        """Move the finished upload to its final path"""
+        # On disk before the rename, so a power cut cannot leave a short copy
+        fd = os.open(self.part_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(self.part_path, path)
+        os.remove(self.info_path)
+        self.persisted = True
+
+    def discard(self):
+        """Delete the upload and its state"""
+        for path in (self.part_path, self.info_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ResumableUploads:
+    """Registry of resumable uploads in progress"""
+
+    def __init__(self, directory, expiry):
+        self.directory = directory
+        self.expiry = expiry
+        self.lock = threading.Lock()
+        self.uploads = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def create(self, filename, size, sha256=None):
+        """Start a new upload and return it"""
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        info = {'filename': filename, 'size': size, 'sha256': sha256, 'created': time.time()}
+        upload = ResumableUpload(self.directory, upload_id, info)
+        with open(upload.info_path, 'w') as f:
+            json.dump(info, f)
+        open(upload.part_path, 'wb').close()
+        with self.lock:
+            self.uploads[upload_id] = upload
+        return upload
+
+    def get(self, upload_id):
+        """Return the upload with this ID, or None"""
+        if len(upload_id) != 32 or any(c not in '0123456789abcdef' for c in upload_id):
+            return None
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                # Started before a restart, reload its state from disk
+                try:
+                    with open(os.path.join(self.directory, f"{upload_id}.json"), 'r') as f:
+                        info = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                upload = self.uploads[upload_id] = ResumableUpload(self.directory, upload_id, info)
+            return upload
+
+    def remove(self, upload_id):
+        """Forget a finished or aborted upload"""
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+    def expire(self):
+        """Delete uploads that have not been finished within the expiry time"""
+        cutoff = time.time() - self.expiry
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    self.remove(name.split('.')[0])
+            except OSError:
+                pass
+
+
+class ContentStore:
+    """Uploaded documents stored by SHA-256, next to artifacts derived from them.
+
+    Each document lives in <root>/<digest>/ together with meta.json (page
+    count and similar), so a repeat upload of the same bytes reuses the work
+    already done for it. Page renders live in the ThumbnailCache.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def doc_dir(self, digest):
+        return os.path.join(self.root, digest)
+
+    def document_path(self, digest):
+        return os.path.join(self.doc_dir(digest), 'document')
+
+    def artifact_path(self, digest, name):
+        return os.path.join(self.doc_dir(digest), name)
+
+    def add(self, digest, spool, size):
+        """Store a finished upload of size bytes, returns (path, duplicate)"""
+        path = self.document_path(digest)
+        with self.lock:
+            try:
+                stored_size = os.path.getsize(path)
+            except OSError:
+                stored_size = None
+            if stored_size == size:
+                # Same bytes already stored, keep the existing copy and its artifacts
+                spool.discard()
+                os.utime(self.doc_dir(digest))
+                return path, True
+            if stored_size is not None:
+                # Damaged copy (e.g. cut short by a power loss), replace it and
+                # drop whatever was derived from it
+                print(f"Replacing damaged copy of {digest[:12]}")
+                shutil.rmtree(self.doc_dir(digest), ignore_errors=True)
+            os.makedirs(self.doc_dir(digest), exist_ok=True)
+            spool.persist(path)
+            return path, False
+
+    def load_meta(self, digest):
+        """Return the derived metadata stored for a document"""
+        try:
+            with open(self.artifact_path(digest, 'meta.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def update_meta(self, digest, **values):
+        """Merge values into a document's metadata"""
+        with self.lock:
+            meta = self.load_meta(digest)
+            meta.update(values)
+            tmp_path = self.artifact_path(digest, 'meta.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, self.artifact_path(digest, 'meta.json'))
+
+    def evict(self, keep=()):
+        """Delete least recently used documents until under max_bytes"""
+        with self.lock:
+            entries = []
+            total = 0
+            for digest in os.listdir(self.root):
+                doc_dir = self.doc_dir(digest)
+                size = 0
+                for dirpath, _, filenames in os.walk(doc_dir):
+                    for name in filenames:
+                        try:
+                            size += os.path.getsize(os.path.join(dirpath, name))
+                        except OSError:
+                            pass
+                total += size
+                entries.append((os.path.getmtime(doc_dir), digest, size))
+            
+            for _, digest, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if digest in keep:
+                    continue
+                shutil.rmtree(self.doc_dir(digest), ignore_errors=True)
+                total -= size
+
+
+class ThumbnailCache:
+    """Rendered pages on disk, keyed by document hash, page, size and colour mode.
+
+    Outlives both the upload queue and the kiosk process, so reopening a
+    preview or re-uploading a document shows pages without running poppler.
+    Least recently used renders are deleted once the cache passes max_bytes.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(size for _, _, size in self._files())
+
+    def path(self, digest, page, box, mode='RGB'):
+        return os.path.join(self.root, digest[:2], f"{digest}_{page}_{box[0]}x{box[1]}_{mode}.png")
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(*key))
+
+    def get(self, digest, page, box, mode='RGB'):
+        """Return the cached render (marking it recently used), or None"""
+        path = self.path(digest, page, box, mode)
+        try:
+            with Image.open(path) as img:
+                img.load()
+                os.utime(path)
+                return img
+        except OSError:
+            return None
+
+    def put(self, digest, page, box, img, mode='RGB'):
+        """Store a render, evicting old ones if the cache is over budget"""
+        path = self.path(digest, page, box, mode)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Several workers may store the same page at once
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, format='PNG')
+        nbytes = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += nbytes
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue  # Still being written
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, path, stat.st_size
+
+    def _evict(self):
+        """Delete least recently used renders down to 90% of max_bytes"""
+        files = sorted(self._files())
+        self.size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+class IngestPipeline:
+    """Pre-processes stored uploads on a worker pool as soon as they arrive.
+
+    Each document is checked to be a readable PDF and inspected for page
+    count, sizes and rotation without rasterizing, so the metadata future
+    completes within milliseconds of the upload. Results are kept in the
+    document's metadata. The first preview pages are then rendered into the
+    thumbnail cache while the user is still on the confirmation screen, on
+    a separate single warm-up thread so a slow render never holds up the
+    metadata of the next upload.
+    """
+
+    def __init__(self, store, thumbnails, workers, mode='RGB'):
+        self.store = store
+        self.thumbnails = thumbnails
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        self.warm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm")
+        self.lock = threading.Lock()
+        self.futures = {}  # digest -> Future of the metadata
+
+    def submit(self, digest):
+        """Start ingesting a document (once), returns a Future of its metadata"""
+        with self.lock:
+            future = self.futures.get(digest)
+            if future is None or (future.done() and not future.result().get('valid')):
+                future = self.futures[digest] = self.executor.submit(self._ingest, digest)
+            return future
+
+    def wait(self, digest):
+        """Block until a document is ingested and return its metadata"""
+        return self.submit(digest).result()
+
+    def _ingest(self, digest):
+        meta = self.store.load_meta(digest)
+        path = self.store.document_path(digest)
+        if meta.get('valid') and 'page_sizes' in meta:
+            if 'large' not in meta:
+                meta['large'] = is_large_document(path, meta['page_count'])
+            self.warm_executor.submit(self._warm, digest, meta)
+            return meta
+        
+        try:
+            with open(path, 'rb') as f:
+                if b'%PDF-' not in f.read(1024):
+                    raise ValueError("Not a PDF document")
+            info = inspect_document(path)
+            if info['page_count'] < 1:
+                raise ValueError("Document has no pages")
+            meta = dict(info, valid=True, large=is_large_document(path, info['page_count']))
+        except Exception as e:
+            print(f"Could not ingest {digest[:12]}: {e}")
+            meta = {'valid': False, 'error': str(e)}
+        
+        try:
+            self.store.update_meta(digest, **meta)
+        except OSError as e:
+            print(f"Could not save metadata for {digest[:12]}: {e}")
+        if meta['valid']:
+            self.warm_executor.submit(self._warm, digest, meta)
+        return meta
+
+    def _warm(self, digest, meta):
+        """Render the first preview pages not cached yet.
+
+        Large documents only get their first LARGE_DOC_WARM_PAGES rendered,
+        by a single poppler process, so one oversized upload cannot tie up
+        every core and the memory of the kiosk.
+        """
+        large = meta.get('large')
+        warm_pages = LARGE_DOC_WARM_PAGES if large else INGEST_WARM_PAGES
+        pages = [
+            page for page in range(min(meta['page_count'], warm_pages))
+            if (digest, page, PREVIEW_SIZE, self.mode) not in self.thumbnails
+        ]
+        if not pages:
+            return
+        
+        try:
+            path = self.store.document_path(digest)
+            page_sizes = meta['page_sizes']
+            # First page on its own so it is ready as early as possible
+            if pages[0] == 0:
+                img = render_page(path, 0, PREVIEW_SIZE, page_sizes[0], self.mode)
+                self.thumbnails.put(digest, 0, PREVIEW_SIZE, img, self.mode)
+                pages = pages[1:]
+            processes = 1 if large else RASTER_PROCESSES
+            for page, img in rasterize_pages(path, pages, PREVIEW_SIZE, page_sizes, self.mode, processes):
+                self.thumbnails.put(digest, page, PREVIEW_SIZE, img, self.mode)
+        except Exception as e:
+            print(f"Could not pre-render {digest[:12]}: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.warm_executor.shutdown(wait=False, cancel_futures=True)
+
+
+class UploadQueue:
+    """Persistent FIFO queue of received uploads.
+
+    Every change is appended to a JSON-lines journal and fsynced, and the
+    journal is replayed on startup. A job stays queued until complete() is
+    called, so a job that was on screen when the kiosk died is offered again
+    after a restart.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()  # job id -> job, oldest first
+        self.claimed = set()
+        self.journal_entries = 0
+        self._replay()
+        self._compact()
+
+    @staticmethod
+    def new_job_id():
+        """Return a unique job ID"""
+        return uuid.uuid4().hex
+
+    def _replay(self):
+        """Rebuild the queue from the journal"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from a crash
+                if entry['op'] == 'add':
+                    self.jobs[entry['job']['id']] = entry['job']
+                elif entry['op'] == 'done':
+                    self.jobs.pop(entry['id'], None)
+
+    def _compact(self):
+        """Rewrite the journal with only the pending jobs"""
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for job in self.jobs.values():
+                f.write(json.dumps({'op': 'add', 'job': job}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self.journal_entries = len(self.jobs)
+
+    def _append(self, entry):
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += 1
+        if self.journal_entries > 2 * len(self.jobs) + 100:
+            self._compact()
+
+    def add(self, job):
+        """Append a job to the end of the queue"""
+        with self.lock:
+            self.jobs[job['id']] = job
+            self._append({'op': 'add', 'job': job})
+
+    def claim(self):
+        """Return the oldest unclaimed job, or None"""
+        with self.lock:
+            for job_id, job in self.jobs.items():
+                if job_id not in self.claimed:
+                    self.claimed.add(job_id)
+                    return job
+            return None
+
+    def complete(self, job_id):
+        """Remove a job from the queue for good"""
+        with self.lock:
+            if self.jobs.pop(job_id, None) is None:
+                return
+            self.claimed.discard(job_id)
+            self._append({'op': 'done', 'id': job_id})
+
+    def pending_count(self):
+        """Number of jobs waiting to be claimed"""
+        with self.lock:
+            return len(self.jobs) - len(self.claimed)
+
+    def digests(self):
+        """Content digests of every queued job"""
+        with self.lock:
+            return {job['digest'] for job in self.jobs.values()}
+
+
+def get_job_states(conn, job_ids):
+    """Return {job id: IPP job-state} for the given jobs.
+
+    Only job-id and job-state are requested. A single job is looked up with
+    Get-Job-Attributes; jobs with nearby IDs are fetched together with one
+    Get-Jobs request bounded by first_job_id and limit, so the cost depends
+    on the jobs asked for and not on how many jobs the queue holds. Jobs
+    CUPS no longer knows about are reported completed.
+    """
+    states = {}
+    job_ids = sorted(set(job_ids))
+    while job_ids:
+        first = job_ids[0]
+        batch = [job_id for job_id in job_ids if job_id < first + JOB_BATCH_SPAN]
+        job_ids = job_ids[len(batch):]
+        
+        if len(batch) == 1:
+            try:
+                attrs = conn.getJobAttributes(first, requested_attributes=['job-id', 'job-state'])
+                states[first] = attrs['job-state']
+            except cups.IPPError as e:
+                if e.args[0] != cups.IPP_NOT_FOUND:
+                    raise
+                states[first] = 9  # Purged from the history, long finished
+            continue
+        
+        jobs = conn.getJobs(
+            which_jobs='all',
+            first_job_id=first,
+            limit=batch[-1] - first + 1,
+            requested_attributes=['job-id', 'job-state']
+        )
+        for job_id in batch:
+            states[job_id] = jobs[job_id]['job-state'] if job_id in jobs else 9
+    return states
+
+
+class CupsConnectionPool:
+    """Thread-safe pool of CUPS connections.
+
+    pycups connections must not be shared between threads, so each checkout
+    hands one connection to the calling thread alone until the with block
+    ends. Connections idle for more than CUPS_CHECK_AFTER are checked with a
+    cheap request before being handed out. Connections that fail with a
+    transport error (cups.HTTPError, RuntimeError, OSError) are dropped and
+    a new connection is made, retrying with backoff while cupsd restarts.
+    Waiting for a free or working connection gives up after the timeout.
+    """
+
+    def __init__(self, size, timeout, connect=cups.Connection):
+        self.timeout = timeout
+        self.connect = connect
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []  # (connection, time it was returned)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the calling thread"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        if not self.slots.acquire(timeout=timeout):
+            raise TimeoutError("No CUPS connection became free")
+        
+        healthy = False
+        try:
+            conn = self._checkout(deadline)
+            try:
+                yield conn
+                healthy = True
+            except Exception as e:
+                # Only transport failures break the connection; IPP errors
+                # (cupsd answered) and the caller's own exceptions leave it
+                # usable. TimeoutError is an OSError but never raised by pycups.
+                healthy = isinstance(e, TimeoutError) or not isinstance(e, (cups.HTTPError, RuntimeError, OSError))
+                raise
+        finally:
+            if healthy:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+            self.slots.release()
+
+    def _checkout(self, deadline):
+        with self.lock:
+            entry = self.idle.pop() if self.idle else None
+        if entry:
+            conn, returned = entry
+            if time.monotonic() - returned < CUPS_CHECK_AFTER:
+                return conn
+            try:
+                conn.getDefault()
+                return conn
+            except Exception:
+                pass  # Stale, cupsd probably restarted
+        
+        delay = 0.1
+        while True:
+            try:
+                return self.connect()
+            except Exception:
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+
+
+class JobTracker:
+    """Follows CUPS print jobs through an IPP notification subscription.
+
+    One pull (ippget) subscription on the printer reports job-state-changed
+    and job-completed events. While a job is being waited on, a background
+    thread fetches only the events it has not seen yet and wakes the
+    threads waiting on those jobs, so cupsd is never asked for its job list
+    and is left alone while the kiosk is idle. If cupsd goes away the
+    subscription is created again and the state of the jobs still being
+    waited on is read directly to catch up on missed events; the same check
+    runs every JOB_STATUS_CHECK_INTERVAL in case an event was dropped.
+    """
+
+    FINAL_STATES = (7, 8, 9)  # IPP job-state canceled, aborted, completed
+
+    def __init__(self, printer, pool):
+        self.printer = printer
+        self.pool = pool
+        self.retry_delay = JOB_RETRY_DELAY
+        self.condition = threading.Condition()
+        self.states = OrderedDict()  # job id -> last known job-state
+        self.waiting = {}  # job id -> threads waiting on it
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="job-tracker", daemon=True)
+        self.thread.start()
+
+    def wait(self, job_id, timeout=None):
+        """Block until a job is canceled, aborted or completed.
+
+        Returns the final IPP job-state, or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.waiting[job_id] = self.waiting.get(job_id, 0) + 1
+            self.condition.notify_all()  # Wake the tracker if it was idle
+            try:
+                while self.states.get(job_id) not in self.FINAL_STATES:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+                return self.states[job_id]
+            finally:
+                self.waiting[job_id] -= 1
+                if not self.waiting[job_id]:
+                    del self.waiting[job_id]
+
+    def _update(self, job_id, state):
+        with self.condition:
+            self.states[job_id] = state
+            self.states.move_to_end(job_id)
+            while len(self.states) > JOB_STATES_KEPT:
+                self.states.popitem(last=False)
+            self.condition.notify_all()
+
+    def _subscribe(self, conn):
+        """Subscribe to job events, returns the subscription id"""
+        subscription = conn.createSubscription(
+            f"ipp://localhost/printers/{self.printer}",
+            events=['job-state-changed', 'job-completed'],
+            lease_duration=JOB_SUBSCRIPTION_LEASE
+        )
+        # Events may have been missed while there was no subscription
+        self._check(conn)
+        return subscription
+
+    def _check(self, conn):
+        """Read the state of the jobs being waited on directly from CUPS"""
+        with self.condition:
+            waiting = list(self.waiting)
+        if waiting:
+            for job_id, state in get_job_states(conn, waiting).items():
+                self._update(job_id, state)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                # The connection stays with this thread while it follows events
+                with self.pool.connection() as conn:
+                    self._follow(conn)
+            except Exception as e:
+                print(f"Job tracking interrupted: {e}")
+                self.stopping.wait(self.retry_delay)
+                self.retry_delay = min(self.retry_delay * 2, 60)
+
+    def _follow(self, conn):
+        """Pull job events while jobs are waited on, until stopped.
+
+        With nothing waited on the thread sleeps and sends cupsd nothing but
+        the occasional lease renewal. Events keep being queued by cupsd, so
+        the first pull after a job is submitted still sees all of them.
+        """
+        subscription = self._subscribe(conn)
+        self.retry_delay = JOB_RETRY_DELAY
+        try:
+            renewed = checked = time.monotonic()
+            next_sequence = 1
+            while not self.stopping.is_set():
+                with self.condition:
+                    if not self.waiting:
+                        self.condition.wait(max(0, renewed + JOB_SUBSCRIPTION_LEASE / 2 - time.monotonic()))
+                    active = bool(self.waiting)
+                if self.stopping.is_set():
+                    break
+                
+                if active:
+                    result = conn.getNotifications([subscription], [next_sequence])
+                    for event in result.get('events', []):
+                        next_sequence = max(next_sequence, event['notify-sequence-number'] + 1)
+                        if 'notify-job-id' in event and 'job-state' in event:
+                            self._update(event['notify-job-id'], event['job-state'])
+                    if time.monotonic() - checked > JOB_STATUS_CHECK_INTERVAL:
+                        self._check(conn)
+                        checked = time.monotonic()
+                if time.monotonic() - renewed > JOB_SUBSCRIPTION_LEASE / 2:
+                    conn.renewSubscription(subscription, lease_duration=JOB_SUBSCRIPTION_LEASE)
+                    renewed = time.monotonic()
+                if active:
+                    self.stopping.wait(JOB_EVENT_INTERVAL)
+        finally:
+            try:
+                conn.cancelSubscription(subscription)
+            except Exception:
+                pass  # Gone with cupsd, it expires with its lease
+
+    def stop(self):
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.thread.join(timeout=2)
+
+
+class PrintSpooler:
+    """Long-lived workers that send print jobs to CUPS and follow them.
+
+    Jobs wait in a bounded submission queue and each worker has at most one
+    CUPS job in flight, so bursts of print requests pipeline through CUPS
+    without a thread per job. A worker holds a pooled CUPS connection only
+    while submitting its job; waiting for the job to finish needs none.
+
+    A job is a dict with file, title, options and two callbacks, called on
+    the worker thread: on_status(status, detail) and on_done(error), where
+    error is None on success.
+    """
+
+    def __init__(self, printer, tracker, pool, workers, queue_size):
+        self.printer = printer
+        self.tracker = tracker
+        self.pool = pool
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.threads = [
+            threading.Thread(target=self._run, name=f"spooler-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, job):
+        """Queue a print job, raises queue.Full if too many are waiting"""
+        self.jobs.put_nowait(job)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                self._print(job)
+                job['on_done'](None)
+            except Exception as e:
+                job['on_done'](str(e))
+
+    def _print(self, job):
+        job['on_status']("Sending to printer...", "⏳ Communicating with HP LaserJet")
+        with self.pool.connection() as conn:
+            job_id = conn.printFile(self.printer, job['file'], job['title'], job['options'])
+        job['on_status']("Printing...", f"📄 Job ID: {job_id}")
+        
+        # Wait for CUPS to report the job finished
+        job_state = self.tracker.wait(job_id, PRINT_JOB_TIMEOUT)
+        if job_state is None:
+            raise Exception("Timed out waiting for the printer")
+        elif job_state == 7:  # Canceled
+            raise Exception("Print job cancelled")
+        elif job_state == 8:  # Aborted
+            raise Exception("Print job aborted by the printer")
+
+    def shutdown(self, wait=False):
+        """Stop the workers once their current jobs are done; queued jobs are dropped"""
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.threads:
+            self.jobs.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+class TimeoutRequestHandler(WSGIRequestHandler):
+    """Request handler that drops clients sending nothing for SERVER_REQUEST_TIMEOUT.
+
+    Werkzeug closes the connection after every response, so a stalled
+    client is the only way a worker can be held up.
+    """
+
+    timeout = SERVER_REQUEST_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server that hands each connection to a fixed pool of worker threads.
+
+    Unlike the development server, which starts a thread per connection,
+    a connection is only accepted once a worker is free, so at most
+    `workers` requests are served at once and further clients wait in the
+    kernel's listen backlog (SERVER_BACKLOG) rather than as open sockets in
+    the process. One request is served per connection. A slow but steady
+    upload keeps its worker until it finishes.
+    """
+
+    multithread = True
+    request_queue_size = SERVER_BACKLOG
+
+    def __init__(self, host, port, app, workers):
+        super().__init__(host, port, app, handler=TimeoutRequestHandler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+        self.free_workers = threading.BoundedSemaphore(workers)
+        self.worker_taken = False
+
+    def _handle_request_noblock(self):
+        # Accept only with a worker free; the timeout lets shutdown() get through
+        if not self.free_workers.acquire(timeout=0.5):
+            return
+        self.worker_taken = False
+        try:
+            super()._handle_request_noblock()
+        finally:
+            if not self.worker_taken:
+                self.free_workers.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_worker, request, client_address)
+        self.worker_taken = True
+
+    def process_request_worker(self, request, client_address):
+        """Serve one connection on a pool thread"""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.free_workers.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+
+
 class PrintKiosk:
     def __init__(self, root):
         self.root = root
@@ -41,8 +1338,20 @@ class PrintKiosk:
         
         # State management
         self.current_screen = "welcome"
+        self.current_job = None
         self.current_file = None
-        self.preview_images = []
+        self.page_cache = PageCache.from_meminfo()  # (digest, page) -> rendered image
+        self.page_cache_budget = self.page_cache.budget
+        self.large_document = False
+        self.photo_cache = PageCache(PHOTO_CACHE_BYTES, sizeof=photo_nbytes)  # (digest, page, box) -> PhotoImage
+        self.tile_cache = PageCache(TILE_CACHE_BYTES)  # (digest, page, zoom, col, row) -> rendered tile
+        self.zoom = 1
+        self.tile_items = {}  # (col, row) -> [canvas item, PhotoImage] of tiles on screen
+        self.preview_pending = {}  # page index -> (Future, is prefetch)
+        self.preview_page_count = 0
+        self.preview_page_sizes = []
+        self.preview_selection = []  # 0-based pages the preview pages through
+        self.preview_generation = 0
         self.current_page = 0
         self.print_settings = {
             'page_range': 'all',
@@ -50,19 +1359,43 @@ class PrintKiosk:
             'duplex': 'none'
         }
         
-        # Easter egg tracking
-        self.konami_progress = []
-        self.secret_clicks = 0
-        
-        # CUPS connection
+        # CUPS connections, one per thread using CUPS at a time
+        self.cups_pool = CupsConnectionPool(CUPS_POOL_SIZE, CUPS_WAIT_TIMEOUT)
         try:
-            self.cups_conn = cups.Connection()
-            self.printers = self.cups_conn.getPrinters()
+            with self.cups_pool.connection(timeout=0) as conn:
+                self.printers = conn.getPrinters()
             if PRINTER_NAME not in self.printers:
                 print(f"Warning: Printer '{PRINTER_NAME}' not found in CUPS")
         except Exception as e:
             print(f"Error connecting to CUPS: {e}")
-            self.cups_conn = None
+            self.printers = {}
+        
+        # Print jobs are sent by the spooler's workers and followed by the
+        # tracker, both reconnect to CUPS in the background if it is not up yet
+        self.job_tracker = JobTracker(PRINTER_NAME, self.cups_pool)
+        self.spooler = PrintSpooler(PRINTER_NAME, self.job_tracker, self.cups_pool, PRINT_WORKERS, PRINT_QUEUE_SIZE)
+        
+        # Previews match what the printer can actually produce
+        self.preview_mode = self.detect_preview_mode()
+        
+        # Upload queue shared with the file receiver
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        self.store = ContentStore(STORE_DIR, STORE_MAX_BYTES)
+        self.upload_queue = UploadQueue(QUEUE_JOURNAL)
+        self.resumable_uploads = ResumableUploads(UPLOADS_DIR, UPLOAD_EXPIRY)
+        self.thumbnails = ThumbnailCache(THUMB_DIR, THUMB_CACHE_MAX_BYTES)
+        self.ingest = IngestPipeline(self.store, self.thumbnails, INGEST_WORKERS, self.preview_mode)
+        for digest in self.upload_queue.digests():
+            self.ingest.submit(digest)
+        
+        # Worker threads hand results to the Tk thread through this queue
+        self.ui_queue = queue.Queue()
+        self.render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        
+        # Easter egg tracking
+        self.konami_progress = []
+        self.secret_clicks = 0
         
         # Bind keyboard for easter eggs
         self.root.bind('<Key>', self.check_konami)
@@ -73,10 +1406,44 @@ class PrintKiosk:
         
         # Start with welcome screen
         self.show_welcome()
+        self.drain_ui_queue()
         
         # Start background server to receive files
+        self.http_server = None
         self.start_file_receiver()
     
+    def detect_preview_mode(self):
+        """Pick the preview image mode from PREVIEW_COLOR_MODE or the printer"""
+        if PREVIEW_COLOR_MODE != 'auto':
+            return PREVIEW_MODES[PREVIEW_COLOR_MODE]
+        if not self.printers:
+            return 'RGB'
+        
+        try:
+            with self.cups_pool.connection(timeout=0) as conn:
+                attrs = conn.getPrinterAttributes(PRINTER_NAME, requested_attributes=['color-supported'])
+        except Exception as e:
+            print(f"Could not read printer colour support: {e}")
+            return 'RGB'
+        return 'RGB' if attrs.get('color-supported') else 'L'
+    
+    def call_in_ui(self, callback):
+        """Run callback on the Tk thread (safe to call from any thread)"""
+        self.ui_queue.put(callback)
+    
+    def drain_ui_queue(self):
+        """Run callbacks queued by worker threads"""
+        while True:
+            try:
+                callback = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback()
+            except Exception as e:
+                print(f"UI callback error: {e}")
+        self.root.after(UI_POLL_INTERVAL, self.drain_ui_queue)
+    
     def clear_screen(self):
         """Clear all widgets from container"""
         for widget in self.container.winfo_children():
@@ -84,6 +1451,7 @@ class PrintKiosk:
     
     def show_welcome(self):
         """Display welcome screen with QR code"""
+        self.finish_current_job()
         self.clear_screen()
         self.current_screen = "welcome"
         
@@ -148,6 +1516,42 @@ class PrintKiosk:
         
         # Pulse animation
         self.animate_pulse(status)
+        
+        # Pick up uploads that arrived while the kiosk was busy
+        self.root.after(0, self.check_upload_queue)
+    
+    def check_upload_queue(self):
+        """Show the next queued upload if the kiosk is idle"""
+        if self.current_screen != "welcome" or self.current_job:
+            return
+        
+        while True:
+            job = self.upload_queue.claim()
+            if job is None:
+                return
+            if os.path.exists(job['path']):
+                break
+            print(f"Dropping queued job {job['id']}: file missing")
+            self.upload_queue.complete(job['id'])
+        
+        self.current_job = job
+        self.current_file = job['path']
+        self.show_file_confirmation(job['filename'], job['size'])
+    
+    def finish_current_job(self):
+        """Remove the active upload from the queue"""
+        if not self.current_job:
+            return
+        
+        # The document stays in the content store for repeat uploads
+        self.cancel_preview_renders()
+        self.upload_queue.complete(self.current_job['id'])
+        stats = self.page_cache.stats()
+        print(f"Preview cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['bytes'] / (1024 * 1024):.1f} of {stats['budget'] / (1024 * 1024):.1f} MB")
+        self.set_large_document(False)
+        self.current_job = None
+        self.current_file = None
     
     def show_file_confirmation(self, filename, filesize):
         """Show file received confirmation"""
@@ -190,6 +1594,31 @@ class PrintKiosk:
             fg='#94a3b8'
         ).pack(pady=5, padx=20)
         
+        # Filled in by the ingest pipeline
+        self.doc_info_label = tk.Label(
+            info_frame,
+            text="Checking document...",
+            font=('Arial', 16),
+            bg='#16213e',
+            fg='#94a3b8'
+        )
+        self.doc_info_label.pack(pady=5, padx=20)
+        job_id = self.current_job['id']
+        self.ingest.submit(self.current_job['digest']).add_done_callback(
+            lambda future: self.call_in_ui(lambda: self.show_ingest_result(job_id, future.result()))
+        )
+        
+        # Queue status
+        waiting = self.upload_queue.pending_count()
+        if waiting:
+            tk.Label(
+                self.container,
+                text=f"{waiting} more document{'s' if waiting > 1 else ''} waiting",
+                font=('Arial', 16),
+                bg='#1a1a2e',
+                fg='#22d3ee'
+            ).pack(pady=5)
+        
         # Buttons
         btn_frame = tk.Frame(self.container, bg='#1a1a2e')
         btn_frame.pack(pady=40)
@@ -224,6 +1653,22 @@ class PrintKiosk:
         )
         cancel_btn.pack(side=tk.LEFT, padx=20)
     
+    def show_ingest_result(self, job_id, meta):
+        """Show page count or validation error on the confirmation screen"""
+        if self.current_screen != "confirmation" or not self.current_job or self.current_job['id'] != job_id:
+            return
+        
+        if meta.get('valid'):
+            pages = meta['page_count']
+            text = f"{pages} page{'s' if pages != 1 else ''}"
+            if pages > MAX_PRINT_PAGES:
+                text += f" · up to {MAX_PRINT_PAGES} can be printed per job"
+            elif meta.get('large'):
+                text += " · large document"
+            self.doc_info_label.config(text=text)
+        else:
+            self.doc_info_label.config(text=f"⚠ {meta.get('error', 'Unreadable document')}", fg='#ef4444')
+    
     def show_preview(self):
         """Display PDF preview and print options"""
         self.clear_screen()
@@ -234,14 +1679,19 @@ class PrintKiosk:
             self.show_welcome()
             return
         
-        # Generate preview images
-        try:
-            self.preview_images = convert_from_path(self.current_file, dpi=150)
-            self.current_page = 0
-        except Exception as e:
-            messagebox.showerror("Error", f"Could not preview file: {e}")
-            self.show_welcome()
-            return
+        # Preview images are generated in the background, results from an
+        # earlier visit to this screen are ignored
+        self.cancel_preview_renders()
+        self.preview_page_count = 0
+        self.preview_selection = []
+        self.current_page = 0
+        self.zoom = 1
+        self.tile_items = {}
+        self.grid_mode = False
+        self.grid_slots = {}  # page -> canvas items showing it
+        self.grid_free_slots = []
+        self.preview_generation += 1
+        generation = self.preview_generation
         
         # Left panel - Preview
         left_panel = tk.Frame(self.container, bg='#1a1a2e')
@@ -256,8 +1706,43 @@ class PrintKiosk:
         ).pack(pady=10)
         
         # Preview canvas
-        self.preview_canvas = tk.Canvas(left_panel, width=500, height=600, bg='white', relief=tk.SUNKEN, bd=2)
-        self.preview_canvas.pack(pady=10)
+        canvas_frame = tk.Frame(left_panel, bg='#1a1a2e')
+        canvas_frame.pack(pady=10)
+        self.preview_canvas = tk.Canvas(canvas_frame, width=500, height=600, bg='white', relief=tk.SUNKEN, bd=2)
+        self.preview_canvas.pack()
+        # Double tap zooms in where tapped, dragging pans a zoomed page
+        self.preview_canvas.bind('<Double-Button-1>', self.preview_double_tap)
+        self.preview_canvas.bind('<ButtonPress-1>', self.preview_press)
+        self.preview_canvas.bind('<B1-Motion>', self.preview_drag)
+        self.preview_canvas.bind('<Control-MouseWheel>', lambda e: self.step_zoom(1 if e.delta > 0 else -1, e.x, e.y))
+        self.preview_canvas.bind('<Control-Button-4>', lambda e: self.step_zoom(1, e.x, e.y))
+        self.preview_canvas.bind('<Control-Button-5>', lambda e: self.step_zoom(-1, e.x, e.y))
+        # Page flips only reconfigure these two items
+        self.preview_item = self.preview_canvas.create_image(250, 300)
+        self.preview_text = self.preview_canvas.create_text(
+            250, 300,
+            font=('Arial', 18),
+            fill='#94a3b8',
+            justify=tk.CENTER,
+            width=440
+        )
+        
+        # Thumbnail grid, shown in place of the preview canvas
+        self.grid_canvas = tk.Canvas(
+            canvas_frame,
+            width=500,
+            height=600,
+            bg='white',
+            relief=tk.SUNKEN,
+            bd=2,
+            yscrollincrement=GRID_CELL[1]
+        )
+        self.grid_canvas.bind('<ButtonPress-1>', self.grid_press)
+        self.grid_canvas.bind('<B1-Motion>', self.grid_drag)
+        self.grid_canvas.bind('<ButtonRelease-1>', self.grid_release)
+        self.grid_canvas.bind('<MouseWheel>', lambda e: self.grid_scroll(-1 if e.delta > 0 else 1))
+        self.grid_canvas.bind('<Button-4>', lambda e: self.grid_scroll(-1))
+        self.grid_canvas.bind('<Button-5>', lambda e: self.grid_scroll(1))
         
         # Navigation
         nav_frame = tk.Frame(left_panel, bg='#1a1a2e')
@@ -275,7 +1760,7 @@ class PrintKiosk:
         
         self.page_label = tk.Label(
             nav_frame,
-            text=f"Page 1 of {len(self.preview_images)}",
+            text="Loading...",
             font=('Arial', 14),
             bg='#1a1a2e',
             fg='#94a3b8'
@@ -292,6 +1777,39 @@ class PrintKiosk:
         )
         self.next_btn.pack(side=tk.LEFT, padx=5)
         
+        self.grid_btn = tk.Button(
+            nav_frame,
+            text="▦ All Pages",
+            font=('Arial', 14),
+            bg='#16213e',
+            fg='white',
+            state=tk.DISABLED,
+            command=self.toggle_grid
+        )
+        self.grid_btn.pack(side=tk.LEFT, padx=15)
+        
+        self.zoom_out_btn = tk.Button(
+            nav_frame,
+            text="－",
+            font=('Arial', 14, 'bold'),
+            bg='#16213e',
+            fg='white',
+            state=tk.DISABLED,
+            command=lambda: self.step_zoom(-1)
+        )
+        self.zoom_out_btn.pack(side=tk.LEFT, padx=2)
+        
+        self.zoom_in_btn = tk.Button(
+            nav_frame,
+            text="＋",
+            font=('Arial', 14, 'bold'),
+            bg='#16213e',
+            fg='white',
+            state=tk.DISABLED,
+            command=lambda: self.step_zoom(1)
+        )
+        self.zoom_in_btn.pack(side=tk.LEFT, padx=2)
+        
         # Right panel - Options
         right_panel = tk.Frame(self.container, bg='#16213e', relief=tk.RAISED, bd=2)
         right_panel.pack(side=tk.RIGHT, fill=tk.BOTH, padx=20, pady=20)
@@ -320,6 +1838,7 @@ class PrintKiosk:
             text="All Pages",
             variable=self.page_range_var,
             value='all',
+            command=self.validate_page_range,
             font=('Arial', 14),
             bg='#16213e',
             fg='white',
@@ -335,6 +1854,7 @@ class PrintKiosk:
             text="Custom:",
             variable=self.page_range_var,
             value='custom',
+            command=self.validate_page_range,
             font=('Arial', 14),
             bg='#16213e',
             fg='white',
@@ -342,9 +1862,21 @@ class PrintKiosk:
             activebackground='#16213e'
         ).pack(side=tk.LEFT)
         
-        self.custom_range = tk.Entry(range_frame, font=('Arial', 14), width=15)
+        self.custom_range_var = tk.StringVar(value=PAGE_RANGE_HINT)
+        self.custom_range = tk.Entry(range_frame, font=('Arial', 14), width=15, textvariable=self.custom_range_var)
         self.custom_range.pack(side=tk.LEFT, padx=10)
-        self.custom_range.insert(0, "e.g. 1-3,5")
+        self.custom_range.bind('<FocusIn>', self.custom_range_focus)
+        self.custom_range_var.trace_add('write', lambda *args: self.validate_page_range())
+        
+        # Live feedback on the custom range
+        self.range_status = tk.Label(
+            right_panel,
+            text="",
+            font=('Arial', 12),
+            bg='#16213e',
+            fg='#94a3b8'
+        )
+        self.range_status.pack(padx=40, anchor='w')
         
         # Orientation
         tk.Label(
@@ -432,7 +1964,8 @@ class PrintKiosk:
         btn_frame = tk.Frame(right_panel, bg='#16213e')
         btn_frame.pack(pady=30, padx=20)
         
-        tk.Button(
+        # Enabled once the page count is known, ranges and limits need it
+        self.print_btn = tk.Button(
             btn_frame,
             text="🖨️ Print",
             font=('Arial', 18, 'bold'),
@@ -442,8 +1975,10 @@ class PrintKiosk:
             relief=tk.FLAT,
             padx=30,
             pady=15,
+            state=tk.DISABLED,
             command=self.start_printing
-        ).pack(pady=10, fill=tk.X)
+        )
+        self.print_btn.pack(pady=10, fill=tk.X)
         
         tk.Button(
             btn_frame,
@@ -458,48 +1993,610 @@ class PrintKiosk:
             command=self.show_welcome
         ).pack(pady=5, fill=tk.X)
         
-        # Show first page
+        # Placeholder until the first page is ready
+        self.prev_btn.config(state=tk.DISABLED)
+        self.next_btn.config(state=tk.DISABLED)
+        self.show_preview_message("Rendering preview...")
+        
+        # Page count comes from the document metadata, pages are rendered on demand
+        self.ingest.submit(self.current_job['digest']).add_done_callback(
+            lambda f: self.call_in_ui(lambda: self.preview_ready(generation, f))
+        )
+    
+    def preview_ready(self, generation, future):
+        """Start paging once the document metadata is known (Tk thread)"""
+        if self.current_screen != "preview" or generation != self.preview_generation:
+            return
+        
+        meta = future.result()
+        if not meta.get('valid'):
+            messagebox.showerror("Error", f"Could not preview file: {meta.get('error', 'Unreadable document')}")
+            self.show_welcome()
+            return
+        self.preview_page_count = meta['page_count']
+        self.preview_page_sizes = meta['page_sizes']
+        self.preview_selection = list(range(self.preview_page_count))
+        self.set_large_document(meta.get('large', False))
+        
+        # Default orientation follows the first page
+        width, height = meta['page_sizes'][0]
+        self.orientation_var.set('landscape' if width > height else 'portrait')
+        self.grid_btn.config(state=tk.NORMAL)
+        self.print_btn.config(state=tk.NORMAL)
         self.update_preview()
+        self.validate_page_range()
+    
+    def set_large_document(self, large):
+        """Switch large-document mode on or off.
+
+        In large-document mode the page cache is held under the fixed
+        LARGE_DOC_CACHE_BYTES ceiling and only the next page is prefetched,
+        so pages stream through memory no matter how long the document is.
+        """
+        self.large_document = large
+        if large:
+            self.page_cache.resize(min(self.page_cache_budget, LARGE_DOC_CACHE_BYTES))
+        else:
+            self.page_cache.resize(self.page_cache_budget)
+    
+    def custom_range_focus(self, event):
+        """Clear the hint and select the custom range when the entry is tapped"""
+        if self.custom_range_var.get() == PAGE_RANGE_HINT:
+            self.custom_range_var.set('')
+        self.page_range_var.set('custom')
+        # Setting the variable does not run the radio button's command
+        self.validate_page_range()
+    
+    def selected_pages(self):
+        """Return the 1-based pages chosen for printing, or None for all.
+
+        Raises ValueError for an invalid custom range.
+        """
+        text = self.custom_range_var.get()
+        if self.page_range_var.get() != 'custom' or text in ('', PAGE_RANGE_HINT):
+            return None
+        return parse_page_range(text, self.preview_page_count)
+    
+    def validate_page_range(self):
+        """Check the page range as it is typed and preview only those pages"""
+        if not self.preview_page_count:
+            return
+        
+        try:
+            pages = self.selected_pages()
+        except ValueError as e:
+            self.range_status.config(text=f"⚠ {e}", fg='#ef4444')
+            return
+        
+        if pages is None:
+            selection = list(range(self.preview_page_count))
+        else:
+            selection = [page - 1 for page in pages]
+        
+        if len(selection) > MAX_PRINT_PAGES:
+            self.range_status.config(text=f"⚠ Select at most {MAX_PRINT_PAGES} pages to print", fg='#f59e0b')
+        elif pages is None:
+            self.range_status.config(text="")
+        else:
+            self.range_status.config(
+                text=f"✓ {len(pages)} page{'s' if len(pages) != 1 else ''} selected",
+                fg='#22c55e'
+            )
+        
+        if selection == self.preview_selection:
+            return
+        self.preview_selection = selection
+        if self.current_page not in selection:
+            self.current_page = selection[0]
+        if self.grid_mode:
+            self.layout_grid()
+        else:
+            self.update_preview()
+    
+    def selection_index(self, page):
+        """Position of a page within the preview selection"""
+        return bisect.bisect_left(self.preview_selection, page)
+    
+    def request_page(self, page, prefetch=False):
+        """Render a preview page in the background unless already underway.
+
+        Prefetches run on their own pool so they never delay the page on
+        screen; a queued prefetch for a page that is now wanted on screen is
+        moved over to the render pool.
+        """
+        if (self.current_job['digest'], page) in self.page_cache:
+            return
+        
+        pending = self.preview_pending.get(page)
+        if pending:
+            future, was_prefetch = pending
+            if prefetch or not was_prefetch or not future.cancel():
+                return
+        
+        pool = self.prefetch_pool if prefetch else self.render_pool
+        generation = self.preview_generation
+        # Pages wanted on screen get a quick draft first
+        on_draft = None if prefetch else (
+            lambda draft: self.call_in_ui(lambda: self.draft_ready(generation, page, draft))
+        )
+        future = pool.submit(
+            self.render_preview_page, self.current_job['digest'], self.current_file, page, self.preview_page_sizes[page],
+            on_draft
+        )
+        self.preview_pending[page] = (future, prefetch)
+        future.add_done_callback(lambda f: self.call_in_ui(lambda: self.page_ready(generation, page, f)))
+    
+    def prefetch_around(self, page):
+        """Render the selected pages next to page in advance, dropping stale prefetches"""
+        index = self.selection_index(page)
+        selection = self.preview_selection
+        ahead, behind = (1, 0) if self.large_document else (PREFETCH_AHEAD, PREFETCH_BEHIND)
+        wanted = [
+            selection[i] for i in range(index - behind, index + ahead + 1)
+            if i != index and 0 <= i < len(selection)
+        ]
+        # Nearest pages first, forward before backward
+        wanted.sort(key=lambda p: (abs(p - page), p < page))
+        
+        for p, (future, prefetch) in list(self.preview_pending.items()):
+            if prefetch and p not in wanted and future.cancel():
+                del self.preview_pending[p]
+        for p in wanted:
+            self.request_page(p, prefetch=True)
+    
+    def cancel_preview_renders(self):
+        """Cancel queued page renders (running ones finish and are ignored)"""
+        for future, _ in self.preview_pending.values():
+            future.cancel()
+        self.preview_pending = {}
+    
+    def render_preview_page(self, digest, path, page, page_size, on_draft=None, box=PREVIEW_SIZE):
+        """Return the preview image for one page (runs on a render worker).
+
+        Pages are rendered straight at PREVIEW_SIZE. Pages rendered by the
+        ingest pipeline, an earlier visit or an earlier upload of the same
+        document are loaded from the thumbnail cache. Otherwise, if on_draft
+        is given, it first receives a low resolution render of the page.
+        """
+        img = self.thumbnails.get(digest, page, box, self.preview_mode)
+        if img is None:
+            if on_draft:
+                draft_box = (box[0] // DRAFT_SCALE, box[1] // DRAFT_SCALE)
+                on_draft(render_page(path, page, draft_box, page_size, self.preview_mode))
+            img = render_page(path, page, box, page_size, self.preview_mode)
+            self.thumbnails.put(digest, page, box, img, self.preview_mode)
+        return img
+    
+    def draft_ready(self, generation, page, draft):
+        """Show a scaled-up draft until the full render replaces it (Tk thread)"""
+        if self.current_screen != "preview" or generation != self.preview_generation or self.grid_mode:
+            return
+        if page != self.current_page or (self.current_job['digest'], page) in self.page_cache:
+            return
+        
+        scale = min(PREVIEW_SIZE[0] / draft.width, PREVIEW_SIZE[1] / draft.height)
+        img = draft.resize((int(draft.width * scale), int(draft.height * scale)), Image.BILINEAR)
+        self.show_preview_photo(ImageTk.PhotoImage(img))
+    
+    def page_ready(self, generation, page, future):
+        """Keep a rendered page and show it if it is on screen (Tk thread)"""
+        if self.current_screen != "preview" or generation != self.preview_generation:
+            return
+        
+        if future.cancelled():
+            return
+        if self.preview_pending.get(page, (None,))[0] is future:
+            del self.preview_pending[page]
+        try:
+            self.page_cache.put((self.current_job['digest'], page), future.result())
+        except Exception as e:
+            if page == self.current_page and not self.grid_mode:
+                self.show_preview_message(f"Could not render page {page + 1}:\n{e}")
+            return
+        if page == self.current_page:
+            self.update_preview()
+    
+    def show_preview_message(self, text):
+        """Replace the preview canvas contents with a message"""
+        self.preview_canvas.itemconfig(self.preview_item, image='')
+        self.preview_canvas.itemconfig(self.preview_text, text=text)
+        self.preview_canvas.image = None
+    
+    def show_preview_photo(self, photo):
+        """Show a display-ready page image on the preview canvas"""
+        self.preview_canvas.itemconfig(self.preview_text, text='')
+        self.preview_canvas.itemconfig(self.preview_item, image=photo)
+        self.preview_canvas.image = photo  # Keep a reference even if evicted from the cache
+    
+    def get_photo(self, page, box):
+        """Return a cached PhotoImage for a page, creating it from the page cache.
+
+        Returns None if the page has not been rendered at this size yet.
+        """
+        digest = self.current_job['digest']
+        photo = self.photo_cache.get((digest, page, box))
+        if photo is None:
+            img = self.page_cache.get((digest, page) if box == PREVIEW_SIZE else (digest, page, box))
+            if img is None:
+                return None
+            photo = ImageTk.PhotoImage(img)
+            self.photo_cache.put((digest, page, box), photo)
+        return photo
     
     def update_preview(self):
         """Update preview canvas with current page"""
-        if not self.preview_images:
+        if not self.preview_page_count or self.grid_mode:
+            return
+        if self.zoom != 1:
+            self.set_zoom(1)
+            return  # set_zoom shows the page again
+        
+        index = self.selection_index(self.current_page)
+        count = len(self.preview_selection)
+        if count == self.preview_page_count:
+            self.page_label.config(text=f"Page {self.current_page + 1} of {self.preview_page_count}")
+        else:
+            self.page_label.config(text=f"Page {self.current_page + 1} ({index + 1} of {count} selected)")
+        
+        self.prev_btn.config(state=tk.NORMAL if index > 0 else tk.DISABLED)
+        self.next_btn.config(state=tk.NORMAL if index < count - 1 else tk.DISABLED)
+        
+        # Pages are rendered at PREVIEW_SIZE, so they are displayed as is
+        photo = self.get_photo(self.current_page, PREVIEW_SIZE)
+        if photo is None:
+            self.show_preview_message(f"Rendering page {self.current_page + 1}...")
+            self.request_page(self.current_page)
+        else:
+            self.show_preview_photo(photo)
+        self.update_zoom_buttons()
+        self.prefetch_around(self.current_page)
+    
+    def update_zoom_buttons(self):
+        """Zooming needs the fitted page rendered, it is the base for the tiles"""
+        rendered = (
+            not self.grid_mode
+            and (self.current_job['digest'], self.current_page) in self.page_cache
+        )
+        self.zoom_in_btn.config(state=tk.NORMAL if rendered and self.zoom < ZOOM_LEVELS[-1] else tk.DISABLED)
+        self.zoom_out_btn.config(state=tk.NORMAL if rendered and self.zoom > ZOOM_LEVELS[0] else tk.DISABLED)
+    
+    def step_zoom(self, steps, x=250, y=300):
+        """Zoom in (steps > 0) or out by whole levels, keeping the point x, y in place"""
+        level = ZOOM_LEVELS.index(self.zoom) + steps
+        self.set_zoom(ZOOM_LEVELS[max(0, min(level, len(ZOOM_LEVELS) - 1))], x, y)
+    
+    def preview_double_tap(self, event):
+        """Zoom in where tapped, or back out from the highest zoom"""
+        if self.zoom == ZOOM_LEVELS[-1]:
+            self.set_zoom(1)
+        else:
+            self.step_zoom(1, event.x, event.y)
+    
+    def preview_press(self, event):
+        self.preview_canvas.scan_mark(event.x, event.y)
+    
+    def preview_drag(self, event):
+        """Pan a zoomed page"""
+        if self.zoom == 1:
+            return
+        self.preview_canvas.scan_dragto(event.x, event.y, gain=1)
+        self.refresh_tiles()
+    
+    def set_zoom(self, zoom, x=250, y=300):
+        """Show the current page at a zoom level, keeping the point x, y in place.
+
+        Zoom level 1 is the fitted page image. Above it the page is laid out
+        as a grid of TILE_SIZE tiles at the zoomed resolution and only the
+        tiles in view are rendered; each starts as an upscaled crop of the
+        fitted page until its sharp render arrives.
+        """
+        canvas = self.preview_canvas
+        base = self.page_cache.get((self.current_job['digest'], self.current_page))
+        if zoom != 1 and base is None:
             return
         
-        img = self.preview_images[self.current_page].copy()
-        img.thumbnail((480, 580))
-        photo = ImageTk.PhotoImage(img)
+        # Point under x, y in fitted page pixels
+        if self.zoom == 1:
+            if base is not None:
+                page_x = x - (250 - base.width / 2)
+                page_y = y - (300 - base.height / 2)
+        else:
+            page_x = canvas.canvasx(x) / self.zoom
+            page_y = canvas.canvasy(y) / self.zoom
+        
+        for item, _ in self.tile_items.values():
+            canvas.delete(item)
+        self.tile_items = {}
+        self.cancel_tile_renders()
+        self.zoom = zoom
+        
+        if zoom == 1:
+            canvas.configure(scrollregion=(0, 0, 500, 600))
+            canvas.xview_moveto(0)
+            canvas.yview_moveto(0)
+            canvas.itemconfig(self.preview_item, state=tk.NORMAL)
+            canvas.itemconfig(self.preview_text, state=tk.NORMAL)
+            self.update_preview()
+            return
         
-        self.preview_canvas.delete('all')
-        self.preview_canvas.create_image(250, 300, image=photo)
-        self.preview_canvas.image = photo
+        canvas.itemconfig(self.preview_item, state=tk.HIDDEN)
+        canvas.itemconfig(self.preview_text, state=tk.HIDDEN)
+        width, height = base.width * zoom, base.height * zoom
+        pad_x, pad_y = max(0, (500 - width) // 2), max(0, (600 - height) // 2)
+        region = (-pad_x, -pad_y, width + pad_x, height + pad_y)
+        canvas.configure(scrollregion=region)
+        canvas.xview_moveto((page_x * zoom - x - region[0]) / (region[2] - region[0]))
+        canvas.yview_moveto((page_y * zoom - y - region[1]) / (region[3] - region[1]))
+        self.update_zoom_buttons()
+        self.page_label.config(text=f"Page {self.current_page + 1} · {zoom}×")
+        self.refresh_tiles()
+    
+    def refresh_tiles(self):
+        """Show the tiles in view of the zoomed page, rendering missing ones"""
+        if self.zoom == 1 or self.grid_mode:
+            return
         
-        self.page_label.config(text=f"Page {self.current_page + 1} of {len(self.preview_images)}")
+        canvas = self.preview_canvas
+        digest = self.current_job['digest']
+        base = self.page_cache.get((digest, self.current_page))
+        if base is None:
+            return
+        width, height = base.width * self.zoom, base.height * self.zoom
+        left, top = canvas.canvasx(0), canvas.canvasy(0)
+        right = canvas.canvasx(int(canvas.cget('width')))
+        bottom = canvas.canvasy(int(canvas.cget('height')))
+        cols = range(max(0, int(left // TILE_SIZE)), min(-(-width // TILE_SIZE), int(right // TILE_SIZE) + 1))
+        rows = range(max(0, int(top // TILE_SIZE)), min(-(-height // TILE_SIZE), int(bottom // TILE_SIZE) + 1))
+        visible = {(col, row) for col in cols for row in rows}
+        
+        # Tiles that scrolled out of view are dropped, their renders cancelled
+        for key in list(self.tile_items):
+            if key not in visible:
+                canvas.delete(self.tile_items.pop(key)[0])
+        self.cancel_tile_renders(keep=visible)
+        
+        for col, row in visible:
+            if (col, row) in self.tile_items:
+                continue
+            x, y = col * TILE_SIZE, row * TILE_SIZE
+            tile = (x, y, min(TILE_SIZE, width - x), min(TILE_SIZE, height - y))
+            img = self.tile_cache.get((digest, self.current_page, self.zoom, col, row))
+            if img is None:
+                # Upscaled crop of the fitted page until the tile is rendered
+                area = (x / self.zoom, y / self.zoom, (x + tile[2]) / self.zoom, (y + tile[3]) / self.zoom)
+                img = base.resize(tile[2:], Image.BILINEAR, box=area)
+                self.request_tile(col, row, (width, height), tile)
+            photo = ImageTk.PhotoImage(img)
+            item = canvas.create_image(x, y, anchor=tk.NW, image=photo)
+            self.tile_items[(col, row)] = [item, photo]
+    
+    def request_tile(self, col, row, size, tile):
+        """Render one zoomed tile of the current page in the background"""
+        key = ('tile', self.current_page, self.zoom, col, row)
+        if key in self.preview_pending:
+            return
         
-        self.prev_btn.config(state=tk.NORMAL if self.current_page > 0 else tk.DISABLED)
-        self.next_btn.config(state=tk.NORMAL if self.current_page < len(self.preview_images) - 1 else tk.DISABLED)
+        generation = self.preview_generation
+        future = self.render_pool.submit(
+            render_tile, self.current_file, self.current_page, size, tile, self.preview_mode
+        )
+        self.preview_pending[key] = (future, False)
+        future.add_done_callback(lambda f: self.call_in_ui(lambda: self.tile_ready(generation, key, f)))
+    
+    def cancel_tile_renders(self, keep=()):
+        """Cancel queued tile renders except those for the (col, row) tiles in keep"""
+        for key, (future, _) in list(self.preview_pending.items()):
+            if key[0] != 'tile':
+                continue
+            _, page, zoom, col, row = key
+            if page == self.current_page and zoom == self.zoom and (col, row) in keep:
+                continue
+            if future.cancel():
+                del self.preview_pending[key]
+    
+    def tile_ready(self, generation, key, future):
+        """Cache a rendered tile and show it if still in view (Tk thread)"""
+        if self.current_screen != "preview" or generation != self.preview_generation or future.cancelled():
+            return
+        if self.preview_pending.get(key, (None,))[0] is future:
+            del self.preview_pending[key]
+        _, page, zoom, col, row = key
+        try:
+            img = future.result()
+        except Exception as e:
+            print(f"Could not render tile {col},{row} of page {page + 1}: {e}")
+            return
+        self.tile_cache.put((self.current_job['digest'], page, zoom, col, row), img)
+        
+        entry = self.tile_items.get((col, row))
+        if entry and page == self.current_page and zoom == self.zoom:
+            entry[1] = ImageTk.PhotoImage(img)
+            self.preview_canvas.itemconfig(entry[0], image=entry[1])
+    
+    def toggle_grid(self):
+        """Switch between single page view and the thumbnail grid"""
+        self.grid_mode = not self.grid_mode
+        
+        if self.grid_mode:
+            if self.zoom != 1:
+                self.set_zoom(1)
+            self.update_zoom_buttons()
+            self.preview_canvas.pack_forget()
+            self.grid_canvas.pack()
+            self.grid_btn.config(text="▣ Single Page")
+            self.prev_btn.config(state=tk.DISABLED)
+            self.next_btn.config(state=tk.DISABLED)
+            self.layout_grid()
+        else:
+            self.grid_canvas.delete('all')
+            self.grid_slots = {}
+            self.grid_free_slots = []
+            self.grid_canvas.pack_forget()
+            self.preview_canvas.pack()
+            self.grid_btn.config(text="▦ All Pages")
+            self.update_preview()
+    
+    def layout_grid(self):
+        """Size the grid for the selected pages and show the rows in view"""
+        canvas = self.grid_canvas
+        canvas.delete('all')
+        self.grid_slots = {}
+        self.grid_free_slots = []
+        
+        count = len(self.preview_selection)
+        rows = (count + GRID_COLUMNS - 1) // GRID_COLUMNS
+        height = rows * GRID_CELL[1]
+        canvas.configure(scrollregion=(0, 0, GRID_COLUMNS * GRID_CELL[0] + 20, height))
+        # Start scrolled to the row of the current page
+        row = self.selection_index(self.current_page) // GRID_COLUMNS
+        canvas.yview_moveto(row * GRID_CELL[1] / max(height, 1))
+        self.page_label.config(text=f"{count} page{'s' if count != 1 else ''}")
+        self.refresh_grid()
+    
+    def refresh_grid(self):
+        """Show thumbnails for the visible rows only, recycling canvas items"""
+        if not self.grid_mode:
+            return
+        
+        canvas = self.grid_canvas
+        top = canvas.canvasy(0)
+        bottom = canvas.canvasy(int(canvas.cget('height')))
+        first = max(0, int(top // GRID_CELL[1]) * GRID_COLUMNS)
+        last = min(len(self.preview_selection), (int(bottom // GRID_CELL[1]) + 1) * GRID_COLUMNS)
+        visible = set(self.preview_selection[first:last])
+        
+        # Free slots that scrolled out of view and drop their queued renders
+        for page in list(self.grid_slots):
+            if page not in visible:
+                slot = self.grid_slots.pop(page)
+                canvas.itemconfig(slot['image'], image='')
+                canvas.itemconfig(slot['label'], text='')
+                slot['photo'] = None
+                self.grid_free_slots.append(slot)
+                pending = self.preview_pending.get(('grid', page))
+                if pending and pending[0].cancel():
+                    del self.preview_pending[('grid', page)]
+        
+        for index in range(first, last):
+            page = self.preview_selection[index]
+            if page in self.grid_slots:
+                continue
+            slot = self.grid_free_slots.pop() if self.grid_free_slots else {
+                'image': canvas.create_image(0, 0),
+                'label': canvas.create_text(0, 0, font=('Arial', 12), fill='#1a1a2e'),
+                'photo': None
+            }
+            self.grid_slots[page] = slot
+            
+            col, row = index % GRID_COLUMNS, index // GRID_COLUMNS
+            x = col * GRID_CELL[0] + GRID_CELL[0] // 2 + 10
+            y = row * GRID_CELL[1]
+            canvas.coords(slot['image'], x, y + GRID_THUMB_SIZE[1] // 2 + 8)
+            canvas.coords(slot['label'], x, y + GRID_CELL[1] - 12)
+            canvas.itemconfig(slot['label'], text=str(page + 1))
+            
+            photo = self.get_photo(page, GRID_THUMB_SIZE)
+            if photo is None:
+                self.request_thumbnail(page)
+            else:
+                self.show_grid_thumbnail(page, photo)
+    
+    def show_grid_thumbnail(self, page, photo):
+        """Put a thumbnail into its grid slot"""
+        slot = self.grid_slots.get(page)
+        if slot is None:
+            return
+        slot['photo'] = photo
+        self.grid_canvas.itemconfig(slot['image'], image=photo)
+    
+    def request_thumbnail(self, page):
+        """Render a grid thumbnail in the background"""
+        key = ('grid', page)
+        if key in self.preview_pending:
+            return
+        
+        generation = self.preview_generation
+        future = self.prefetch_pool.submit(
+            self.render_preview_page, self.current_job['digest'], self.current_file, page,
+            self.preview_page_sizes[page], None, GRID_THUMB_SIZE
+        )
+        self.preview_pending[key] = (future, True)
+        future.add_done_callback(lambda f: self.call_in_ui(lambda: self.thumbnail_ready(generation, page, f)))
+    
+    def thumbnail_ready(self, generation, page, future):
+        """Cache a rendered thumbnail and show it if still visible (Tk thread)"""
+        if self.current_screen != "preview" or generation != self.preview_generation or future.cancelled():
+            return
+        if self.preview_pending.get(('grid', page), (None,))[0] is future:
+            del self.preview_pending[('grid', page)]
+        try:
+            img = future.result()
+        except Exception as e:
+            print(f"Could not render thumbnail {page + 1}: {e}")
+            return
+        self.page_cache.put((self.current_job['digest'], page, GRID_THUMB_SIZE), img)
+        if self.grid_mode and page in self.grid_slots:
+            self.show_grid_thumbnail(page, self.get_photo(page, GRID_THUMB_SIZE))
+    
+    def grid_scroll(self, rows):
+        """Scroll the grid by whole rows (mouse wheel)"""
+        self.grid_canvas.yview_scroll(rows, 'units')
+        self.refresh_grid()
+    
+    def grid_press(self, event):
+        self.grid_press_y = event.y
+        self.grid_canvas.scan_mark(0, event.y)
+    
+    def grid_drag(self, event):
+        self.grid_canvas.scan_dragto(0, event.y, gain=1)
+        self.refresh_grid()
+    
+    def grid_release(self, event):
+        """Open the tapped page (a drag only scrolls)"""
+        if abs(event.y - self.grid_press_y) > 10:
+            return
+        
+        col = int((self.grid_canvas.canvasx(event.x) - 10) // GRID_CELL[0])
+        row = int(self.grid_canvas.canvasy(event.y) // GRID_CELL[1])
+        index = row * GRID_COLUMNS + col
+        if 0 <= col < GRID_COLUMNS and index < len(self.preview_selection):
+            self.current_page = self.preview_selection[index]
+            self.toggle_grid()
     
     def prev_page(self):
-        """Show previous page"""
-        if self.current_page > 0:
-            self.current_page -= 1
+        """Show previous selected page"""
+        index = self.selection_index(self.current_page)
+        if index > 0:
+            self.current_page = self.preview_selection[index - 1]
             self.update_preview()
     
     def next_page(self):
-        """Show next page"""
-        if self.current_page < len(self.preview_images) - 1:
-            self.current_page += 1
+        """Show next selected page"""
+        index = self.selection_index(self.current_page)
+        if index < len(self.preview_selection) - 1:
+            self.current_page = self.preview_selection[index + 1]
             self.update_preview()
     
     def start_printing(self):
         """Begin print job"""
+        if not self.preview_page_count:
+            return  # Metadata not read yet, the button is still disabled
+        
         # Collect settings
-        if self.page_range_var.get() == 'custom':
-            page_range = self.custom_range.get()
-            if page_range == "e.g. 1-3,5":
-                page_range = 'all'
-        else:
-            page_range = 'all'
+        try:
+            pages = self.selected_pages()
+        except ValueError as e:
+            messagebox.showerror("Invalid Page Range", str(e))
+            return
+        page_range = 'all' if pages is None else format_page_range(pages)
+        
+        if (self.preview_page_count if pages is None else len(pages)) > MAX_PRINT_PAGES:
+            messagebox.showerror(
+                "Too Many Pages",
+                f"Up to {MAX_PRINT_PAGES} pages can be printed per job. "
+                f"Choose a custom page range."
+            )
+            return
         
         self.print_settings = {
             'page_range': page_range,
@@ -507,10 +2604,22 @@ class PrintKiosk:
             'duplex': self.duplex_var.get()
         }
         
-        self.show_printing()
+        # Hand the job to the spooler, it reports back through the UI queue
+        # (drained on this thread, so the printing screen is up first)
+        try:
+            self.spooler.submit({
+                'file': self.current_file,
+                'title': "Print Job",
+                'options': self.print_options(),
+                'on_status': lambda status, detail: self.call_in_ui(lambda: self.print_status(status, detail)),
+                'on_done': lambda error: self.call_in_ui(lambda: self.print_done(error))
+            })
+        except queue.Full:
+            # Stay on the preview, the upload remains queued
+            messagebox.showerror("Printer Busy", "The printer queue is full, please try again in a moment")
+            return
         
-        # Start printing in background thread
-        threading.Thread(target=self.do_print, daemon=True).start()
+        self.show_printing()
     
     def show_printing(self):
         """Show printing status screen"""
@@ -574,70 +2683,44 @@ class PrintKiosk:
         self.spinner_angle = (self.spinner_angle + 10) % 360
         self.root.after(50, self.draw_spinner)
     
-    def do_print(self):
-        """Execute print job using CUPS"""
-        try:
-            # Update status
-            self.root.after(0, lambda: self.status_label.config(text="Sending to printer..."))
-            self.root.after(0, lambda: self.progress_label.config(text="⏳ Communicating with HP LaserJet"))
-            
-            time.sleep(1)
-            
-            if not self.cups_conn:
-                raise Exception("CUPS connection not available")
-            
-            # Prepare CUPS options
-            options = {}
-            
-            # Page range
-            if self.print_settings['page_range'] != 'all':
-                options['page-ranges'] = self.print_settings['page_range']
-            
-            # Orientation
-            if self.print_settings['orientation'] == 'landscape':
-                options['orientation-requested'] = '4'
-            else:
-                options['orientation-requested'] = '3'
-            
-            # Duplex
-            if self.print_settings['duplex'] == 'long':
-                options['sides'] = 'two-sided-long-edge'
-            elif self.print_settings['duplex'] == 'short':
-                options['sides'] = 'two-sided-short-edge'
-            else:
-                options['sides'] = 'one-sided'
-            
-            # Submit print job
-            job_id = self.cups_conn.printFile(
-                PRINTER_NAME,
-                self.current_file,
-                "Print Job",
-                options
-            )
-            
-            self.root.after(0, lambda: self.status_label.config(text="Printing..."))
-            self.root.after(0, lambda: self.progress_label.config(text=f"📄 Job ID: {job_id}"))
-            
-            # Monitor job status
-            while True:
-                time.sleep(1)
-                jobs = self.cups_conn.getJobs()
-                if job_id not in jobs:
-                    break
-                
-                job_state = jobs[job_id]['job-state']
-                if job_state == 9:  # Completed
-                    break
-                elif job_state == 8:  # Cancelled
-                    raise Exception("Print job cancelled")
-            
-            # Success!
-            self.root.after(0, self.show_success)
-            
-        except Exception as e:
-            print(f"Print error: {e}")
-            self.root.after(0, lambda: messagebox.showerror("Print Error", str(e)))
-            self.root.after(0, self.show_welcome)
+    def print_options(self):
+        """CUPS job options for the current print settings"""
+        options = {}
+        
+        # Page range
+        if self.print_settings['page_range'] != 'all':
+            options['page-ranges'] = self.print_settings['page_range']
+        
+        # Orientation
+        if self.print_settings['orientation'] == 'landscape':
+            options['orientation-requested'] = '4'
+        else:
+            options['orientation-requested'] = '3'
+        
+        # Duplex
+        if self.print_settings['duplex'] == 'long':
+            options['sides'] = 'two-sided-long-edge'
+        elif self.print_settings['duplex'] == 'short':
+            options['sides'] = 'two-sided-short-edge'
+        else:
+            options['sides'] = 'one-sided'
+        return options
+    
+    def print_status(self, status, detail):
+        """Show spooler progress on the printing screen (Tk thread)"""
+        if self.current_screen != "printing":
+            return
+        self.status_label.config(text=status)
+        self.progress_label.config(text=detail)
+    
+    def print_done(self, error):
+        """Finish the printing screen once the job is done (Tk thread)"""
+        if error is None:
+            self.show_success()
+            return
+        print(f"Print error: {error}")
+        messagebox.showerror("Print Error", error)
+        self.show_welcome()
     
     def show_success(self):
         """Show success screen"""
@@ -758,6 +2841,10 @@ class PrintKiosk:
     def start_file_receiver(self):
         """Start Flask server to receive files from web app"""
         app = Flask(__name__)
+        app.request_class = UploadRequest
+        # Reject oversized uploads from Content-Length before reading the body,
+        # allowing a little extra for the multipart framing
+        app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + UPLOAD_CHUNK_SIZE
         
         @app.route('/receive_file', methods=['POST'])
         def receive_file():
@@ -769,43 +2856,189 @@ class PrintKiosk:
                 if file.filename == '':
                     return jsonify({'success': False, 'error': 'Empty filename'}), 400
                 
-                # Save file
-                temp_dir = tempfile.gettempdir()
-                filepath = os.path.join(temp_dir, f"print_{int(time.time())}_{file.filename}")
-                file.save(filepath)
-                
-                # Get file info
-                filesize = os.path.getsize(filepath)
-                
-                # Update UI on main thread
-                self.current_file = filepath
-                self.root.after(0, lambda: self.show_file_confirmation(file.filename, filesize))
+                # Move the spooled upload into the content store (no second copy),
+                # or drop it if the same document is already stored
+                digest = file.stream.hexdigest()
+                filepath, duplicate = self.store.add(digest, file.stream, file.stream.size)
+                job_id = self.enqueue_upload(file.filename, digest, filepath, file.stream.size)
                 
                 return jsonify({
                     'success': True,
                     'message': 'File received',
-                    'filename': file.filename
+                    'filename': file.filename,
+                    'job_id': job_id,
+                    'duplicate': duplicate,
+                    'queue_position': self.upload_queue.pending_count()
                 })
                 
+            except RequestEntityTooLarge as e:
+                print(f"Rejected upload: {e.description}")
+                return jsonify({'success': False, 'error': e.description}), 413
             except Exception as e:
                 print(f"Error receiving file: {e}")
                 return jsonify({'success': False, 'error': str(e)}), 500
+            finally:
+                request.discard_spool_files()
         
-        # Run Flask in background thread
-        def run_server():
-            app.run(host='0.0.0.0', port=5001, debug=False, use_reloader=False)
+        # Resumable uploads: POST /uploads, then PATCH chunks at Upload-Offset
+        # (HEAD reports the offset after a dropped connection), then finalize
+        @app.route('/uploads', methods=['POST'])
+        def create_upload():
+            try:
+                data = request.get_json(silent=True) or {}
+                filename = data.get('filename')
+                size = data.get('size')
+                sha256 = data.get('sha256')
+                if not filename or not isinstance(size, int) or size <= 0:
+                    return jsonify({'success': False, 'error': 'filename and size are required'}), 400
+                if size > MAX_UPLOAD_SIZE:
+                    return jsonify({'success': False, 'error': f"Upload exceeds {MAX_UPLOAD_SIZE // (1024 * 1024)} MB limit"}), 413
+                # Only checked against the received bytes on finalize, never
+                # trusted on its own (knowing a hash must not allow printing it)
+                if sha256 is not None and not (
+                    isinstance(sha256, str) and re.fullmatch(r'[0-9a-f]{64}', sha256)
+                ):
+                    return jsonify({'success': False, 'error': 'sha256 must be 64 lowercase hex digits'}), 400
+                
+                upload = self.resumable_uploads.create(filename, size, sha256)
+                return jsonify({
+                    'success': True,
+                    'complete': False,
+                    'upload_id': upload.upload_id,
+                    'offset': 0
+                }), 201, {'Location': f"/uploads/{upload.upload_id}", 'Upload-Offset': '0'}
+                
+            except Exception as e:
+                print(f"Error creating upload: {e}")
+                return jsonify({'success': False, 'error': str(e)}), 500
+        
+        @app.route('/uploads/<upload_id>', methods=['HEAD', 'GET'])
+        def upload_status(upload_id):
+            upload = self.resumable_uploads.get(upload_id)
+            if upload is None:
+                return jsonify({'success': False, 'error': 'Unknown upload'}), 404
+            offset = upload.offset
+            return jsonify({
+                'success': True,
+                'offset': offset,
+                'size': upload.info['size']
+            }), 200, {'Upload-Offset': str(offset), 'Upload-Length': str(upload.info['size'])}
+        
+        @app.route('/uploads/<upload_id>', methods=['PATCH'])
+        def upload_chunk(upload_id):
+            upload = self.resumable_uploads.get(upload_id)
+            if upload is None:
+                return jsonify({'success': False, 'error': 'Unknown upload'}), 404
+            if not upload.lock.acquire(blocking=False):
+                return jsonify({'success': False, 'error': 'Upload busy'}), 409
+            try:
+                offset = upload.offset
+                try:
+                    requested = int(request.headers.get('Upload-Offset', ''))
+                except ValueError:
+                    return jsonify({'success': False, 'error': 'Upload-Offset header required'}), 400
+                if requested != offset:
+                    return jsonify({'success': False, 'error': 'Offset mismatch', 'offset': offset}), 409, {'Upload-Offset': str(offset)}
+                length = request.content_length
+                if length is None or length > upload.info['size'] - offset:
+                    return jsonify({'success': False, 'error': 'Chunk must fit the declared size', 'offset': offset}), 413
+                
+                offset = upload.append(request.stream, length)
+                return jsonify({'success': True, 'offset': offset}), 200, {'Upload-Offset': str(offset)}
+                
+            except Exception as e:
+                print(f"Error receiving chunk for {upload_id}: {e}")
+                return jsonify({'success': False, 'error': str(e), 'offset': upload.offset}), 500
+            finally:
+                upload.lock.release()
+        
+        @app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+        def finalize_upload(upload_id):
+            upload = self.resumable_uploads.get(upload_id)
+            if upload is None:
+                return jsonify({'success': False, 'error': 'Unknown upload'}), 404
+            if not upload.lock.acquire(blocking=False):
+                return jsonify({'success': False, 'error': 'Upload busy'}), 409
+            try:
+                if not upload.complete:
+                    return jsonify({'success': False, 'error': 'Upload incomplete', 'offset': upload.offset}), 409
+                
+                digest = upload.hexdigest()
+                if upload.info['sha256'] and upload.info['sha256'] != digest:
+                    upload.discard()
+                    self.resumable_uploads.remove(upload_id)
+                    return jsonify({'success': False, 'error': 'Checksum mismatch'}), 422
+                
+                filepath, duplicate = self.store.add(digest, upload, upload.info['size'])
+                self.resumable_uploads.remove(upload_id)
+                job_id = self.enqueue_upload(upload.info['filename'], digest, filepath, upload.info['size'])
+                
+                return jsonify({
+                    'success': True,
+                    'message': 'File received',
+                    'filename': upload.info['filename'],
+                    'job_id': job_id,
+                    'duplicate': duplicate,
+                    'queue_position': self.upload_queue.pending_count()
+                })
+                
+            except Exception as e:
+                print(f"Error finalizing upload {upload_id}: {e}")
+                return jsonify({'success': False, 'error': str(e)}), 500
+            finally:
+                upload.lock.release()
+        
+        @app.route('/uploads/<upload_id>', methods=['DELETE'])
+        def abort_upload(upload_id):
+            upload = self.resumable_uploads.get(upload_id)
+            if upload is None:
+                return jsonify({'success': False, 'error': 'Unknown upload'}), 404
+            with upload.lock:
+                upload.discard()
+                self.resumable_uploads.remove(upload_id)
+            return jsonify({'success': True})
+        
+        # Run server in background thread
+        if SERVER_MODE == "pooled":
+            self.http_server = PooledWSGIServer('0.0.0.0', SERVER_PORT, app, SERVER_WORKERS)
+            run_server = self.http_server.serve_forever
+        else:
+            def run_server():
+                app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, use_reloader=False)
         
         server_thread = threading.Thread(target=run_server, daemon=True)
         server_thread.start()
-        print("File receiver started on port 5001")
+        print(f"File receiver started on port {SERVER_PORT} ({SERVER_MODE} mode)")
+    
+    def enqueue_upload(self, filename, digest, filepath, size):
+        """Queue a stored upload for the UI, returns the job ID"""
+        job_id = self.upload_queue.new_job_id()
+        self.upload_queue.add({
+            'id': job_id,
+            'filename': filename,
+            'digest': digest,
+            'path': filepath,
+            'size': size,
+            'received': time.time()
+        })
+        
+        # Start pre-processing, and let the UI pick it up on the main thread
+        self.ingest.submit(digest)
+        self.call_in_ui(self.check_upload_queue)
+        self.store.evict(keep=self.upload_queue.digests())
+        return job_id
     
     def cleanup(self):
         """Cleanup on exit"""
-        if self.current_file and os.path.exists(self.current_file):
-            try:
-                os.remove(self.current_file)
-            except:
-                pass
+        # Queued uploads (including the one on screen) are kept for the next start
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+        self.ingest.shutdown()
+        self.spooler.shutdown()
+        self.job_tracker.stop()
+        self.render_pool.shutdown(wait=False, cancel_futures=True)
+        self.prefetch_pool.shutdown(wait=False, cancel_futures=True)
 
 
 def main():